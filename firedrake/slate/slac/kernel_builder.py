@@ -1,9 +1,11 @@
-import numpy as np
 from coffee import base as ast
 
-from collections import OrderedDict, Counter, namedtuple
-from functools import singledispatch
+from collections import OrderedDict, Counter, defaultdict, namedtuple
+from functools import singledispatch, lru_cache, reduce
+from itertools import chain
+from operator import mul
 
+from firedrake.slate.slac.tsfc_driver import compile_terminal_form
 from firedrake.slate.slac.utils import traverse_dags, eigen_tensor, Transformer
 from firedrake.utils import cached_property
 
@@ -33,6 +35,90 @@ Context information for creating coefficient temporaries.
 """
 
 
+@lru_cache(maxsize=None)
+def _space_dim(element):
+    """Returns the number of nodal unknowns of a UFL element.
+
+    Results are keyed on the element, so ``space_dimension()`` is only
+    evaluated once per UFL element.
+    """
+    return create_element(element).space_dimension()
+
+
+def _prod(shape):
+    """Product of the extents in a (short) shape tuple, computed
+    without going through NumPy."""
+    return reduce(mul, shape, 1)
+
+
+@singledispatch
+def _flops(expr):
+    """Estimates the number of floating point operations needed to
+    evaluate a Slate node (excluding its operands).
+    """
+    raise AssertionError("Unhandled type %r" % type(expr))
+
+
+@_flops.register(slate.AssembledVector)
+@_flops.register(slate.Block)
+@_flops.register(slate.Tensor)
+@_flops.register(slate.Transpose)
+@_flops.register(slate.Negative)
+def _flops_none(expr):
+    return 0
+
+
+# Leading coefficient of the n**3 cost of each decomposition.
+# Extracted from Golub & Van Loan
+# These all ignore lower-order terms...
+_factorization_flops = {"PartialPivLU": 2/3,
+                        "FullPivLU": 2/3,
+                        "LLT": 1/3,
+                        "LDLT": 1/3,
+                        "HouseholderQR": 4/3,
+                        "ColPivHouseholderQR": 4/3,
+                        "FullPivHouseholderQR": 4/3,
+                        "BDCSVD": 12,
+                        "JacobiSVD": 12}
+
+
+@_flops.register(slate.Factorization)
+def _flops_factorization(expr):
+    m, n = expr.shape
+    # Don't know, but don't barf just because of it.
+    return _factorization_flops.get(expr.decomposition, 0) * n**3
+
+
+@_flops.register(slate.Inverse)
+def _flops_inverse(expr):
+    m, n = expr.shape
+    assert m == n
+    # Assume LU factorisation
+    return (2/3)*n**3
+
+
+@_flops.register(slate.Add)
+def _flops_add(expr):
+    return _prod(expr.shape)
+
+
+@_flops.register(slate.Mul)
+def _flops_mul(expr):
+    A, B = expr.operands
+    *rest_a, col = A.shape
+    _, *rest_b = B.shape
+    return 2*col*_prod(rest_a)*_prod(rest_b)
+
+
+@_flops.register(slate.Solve)
+def _flops_solve(expr):
+    Afac, B = expr.operands
+    _, *rest = B.shape
+    m, n = Afac.shape
+    # Forward elimination + back sub on factorised matrix
+    return (m*n + n**2)*_prod(rest)
+
+
 class LocalKernelBuilder(object):
     """The primary helper class for constructing cell-local linear
     algebra kernels from Slate expressions.
@@ -71,9 +157,23 @@ class LocalKernelBuilder(object):
         "exterior_facet_vert"
     ]
 
-    # Supported subdomain types
-    supported_subdomain_types = ["subdomains_exterior_facet",
-                                 "subdomains_interior_facet"]
+    # Maps integral type to subdomain key
+    subdomain_map = {"exterior_facet": "subdomains_exterior_facet",
+                     "exterior_facet_vert": "subdomains_exterior_facet",
+                     "interior_facet": "subdomains_interior_facet",
+                     "interior_facet_vert": "subdomains_interior_facet"}
+
+    # Integral types which require looping over cell facets
+    cell_facet_types = frozenset(["interior_facet",
+                                  "exterior_facet",
+                                  "interior_facet_vert",
+                                  "exterior_facet_vert"])
+
+    # Integral types which require mesh layer information
+    mesh_layer_types = frozenset(["interior_facet_horiz_top",
+                                  "interior_facet_horiz_bottom",
+                                  "exterior_facet_bottom",
+                                  "exterior_facet_top"])
 
     def __init__(self, expression, tsfc_parameters=None):
         """Constructor for the LocalKernelBuilder class.
@@ -91,28 +191,27 @@ class LocalKernelBuilder(object):
         temps = OrderedDict()
         coeff_vecs = OrderedDict()
         seen_coeff = set()
-        expression_dag = list(traverse_dags([expression]))
+        expression_dag = []
         counter = Counter([expression])
-        for tensor in expression_dag:
+        for tensor in traverse_dags([expression]):
+            expression_dag.append(tensor)
             counter.update(tensor.operands)
 
             # Terminal tensors will always require a temporary.
-            if isinstance(tensor, slate.Tensor):
+            if type(tensor) is slate.Tensor:
                 temps.setdefault(tensor, ast.Symbol("T%d" % len(temps)))
 
             # 'AssembledVector's will always require a coefficient temporary.
-            if isinstance(tensor, slate.AssembledVector):
+            elif type(tensor) is slate.AssembledVector:
                 function = tensor._function
 
-                def dimension(e):
-                    return create_element(e).space_dimension()
-
                 # Ensure coefficient temporaries aren't duplicated
                 if function not in seen_coeff:
-                    if type(function.ufl_element()) == MixedElement:
-                        shapes = [dimension(element) for element in function.ufl_element().sub_elements()]
+                    element = function.ufl_element()
+                    if type(element) == MixedElement:
+                        shapes = [_space_dim(e) for e in element.sub_elements()]
                     else:
-                        shapes = [dimension(function.ufl_element())]
+                        shapes = [_space_dim(element)]
 
                     # Local temporary
                     local_temp = ast.Symbol("VecTemp%d" % len(seen_coeff))
@@ -143,77 +242,21 @@ class LocalKernelBuilder(object):
         nfacets = self.expression.ufl_domain().ufl_cell().num_facets()
         for ctx in self.context_kernels:
             itype = ctx.original_integral_type
+            if itype == "cell":
+                nexec = 1
+            elif itype.startswith("interior_facet"):
+                # Executed once per facet (approximation)
+                nexec = nfacets
+            else:
+                # Exterior facets basically contribute zero flops
+                continue
             for k in ctx.tsfc_kernels:
-                kinfo = k.kinfo
-                if itype == "cell":
-                    flops += kinfo.kernel.num_flops
-                elif itype.startswith("interior_facet"):
-                    # Executed once per facet (approximation)
-                    flops += kinfo.kernel.num_flops * nfacets
-                else:
-                    # Exterior facets basically contribute zero flops
-                    pass
+                flops += k.kinfo.kernel.num_flops * nexec
         return int(flops)
 
     @cached_property
     def expression_flops(self):
-        @singledispatch
-        def _flops(expr):
-            raise AssertionError("Unhandled type %r" % type(expr))
-
-        @_flops.register(slate.AssembledVector)
-        @_flops.register(slate.Block)
-        @_flops.register(slate.Tensor)
-        @_flops.register(slate.Transpose)
-        @_flops.register(slate.Negative)
-        def _flops_none(expr):
-            return 0
-
-        @_flops.register(slate.Factorization)
-        def _flops_factorization(expr):
-            m, n = expr.shape
-            decomposition = expr.decomposition
-            # Extracted from Golub & Van Loan
-            # These all ignore lower-order terms...
-            if decomposition in {"PartialPivLU", "FullPivLU"}:
-                return 2/3 * n**3
-            elif decomposition in {"LLT", "LDLT"}:
-                return (1/3)*n**3
-            elif decomposition in {"HouseholderQR", "ColPivHouseholderQR", "FullPivHouseholderQR"}:
-                return 4/3 * n**3
-            elif decomposition in {"BDCSVD", "JacobiSVD"}:
-                return 12 * n**3
-            else:
-                # Don't know, but don't barf just because of it.
-                return 0
-
-        @_flops.register(slate.Inverse)
-        def _flops_inverse(expr):
-            m, n = expr.shape
-            assert m == n
-            # Assume LU factorisation
-            return (2/3)*n**3
-
-        @_flops.register(slate.Add)
-        def _flops_add(expr):
-            return int(np.prod(expr.shape))
-
-        @_flops.register(slate.Mul)
-        def _flops_mul(expr):
-            A, B = expr.operands
-            *rest_a, col = A.shape
-            _, *rest_b = B.shape
-            return 2*col*int(np.prod(rest_a))*int(np.prod(rest_b))
-
-        @_flops.register(slate.Solve)
-        def _flops_solve(expr):
-            Afac, B = expr.operands
-            _, *rest = B.shape
-            m, n = Afac.shape
-            # Forward elimination + back sub on factorised matrix
-            return (m*n + n**2)*int(np.prod(rest))
-
-        return int(sum(map(_flops, traverse_dags([self.expression]))))
+        return int(sum(map(_flops, self.expression_dag)))
 
     def _setup(self):
         """A setup method to initialize all the local assembly
@@ -225,17 +268,15 @@ class LocalKernelBuilder(object):
         transformer = Transformer()
         include_dirs = []
         templated_subkernels = []
-        assembly_calls = OrderedDict([(it, []) for it in self.supported_integral_types])
-        subdomain_calls = OrderedDict([(sd, []) for sd in self.supported_subdomain_types])
+        # Calls are only collected for the integral (subdomain) types
+        # which actually occur; absent types look up as empty lists.
+        assembly_calls = defaultdict(list)
+        subdomain_calls = defaultdict(list)
         coords = None
         oriented = False
         needs_cell_sizes = False
+        coefficient_syms = self._coefficient_map_by_id
 
-        # Maps integral type to subdomain key
-        subdomain_map = {"exterior_facet": "subdomains_exterior_facet",
-                         "exterior_facet_vert": "subdomains_exterior_facet",
-                         "interior_facet": "subdomains_interior_facet",
-                         "interior_facet_vert": "subdomains_interior_facet"}
         for cxt_kernel in self.context_kernels:
             local_coefficients = cxt_kernel.coefficients
             it_type = cxt_kernel.original_integral_type
@@ -245,7 +286,7 @@ class LocalKernelBuilder(object):
                 raise ValueError("Integral type '%s' not recognized" % it_type)
 
             # Explicit checking of coordinates
-            coordinates = cxt_kernel.tensor.ufl_domain().coordinates
+            coordinates = exp.ufl_domain().coordinates
             if coords is not None:
                 assert coordinates == coords, "Mismatching coordinates!"
             else:
@@ -257,16 +298,14 @@ class LocalKernelBuilder(object):
                 kint_type = kinfo.integral_type
                 needs_cell_sizes = needs_cell_sizes or kinfo.needs_cell_sizes
 
-                args = [c for i in kinfo.coefficient_map
-                        for c in self.coefficient(local_coefficients[i])]
+                args = list(chain.from_iterable(
+                    coefficient_syms[id(local_coefficients[i])]
+                    for i in kinfo.coefficient_map))
 
                 if kinfo.oriented:
                     args.insert(0, self.cell_orientations_sym)
 
-                if kint_type in ["interior_facet",
-                                 "exterior_facet",
-                                 "interior_facet_vert",
-                                 "exterior_facet_vert"]:
+                if kint_type in self.cell_facet_types:
                     args.append(ast.FlatBlock("&%s" % self.it_sym))
 
                 if kinfo.needs_cell_sizes:
@@ -281,22 +320,28 @@ class LocalKernelBuilder(object):
 
                 # Subdomains only implemented for exterior facet integrals
                 if kinfo.subdomain_id != "otherwise":
-                    if kint_type not in subdomain_map:
+                    if kint_type not in self.subdomain_map:
                         msg = "Subdomains for integral type '%s' not implemented" % kint_type
                         raise NotImplementedError(msg)
 
                     sd_id = kinfo.subdomain_id
-                    sd_key = subdomain_map[kint_type]
+                    sd_key = self.subdomain_map[kint_type]
                     subdomain_calls[sd_key].append((sd_id, call))
                 else:
                     assembly_calls[it_type].append(call)
 
-                # Subkernels for local assembly (Eigen templated functions)
-                from coffee.base import Node
-                assert isinstance(kinfo.kernel._code, Node)
-                kast = transformer.visit(kinfo.kernel._code)
+                # Subkernels for local assembly (Eigen templated functions).
+                # These only depend on the TSFC kernel code, so they are
+                # stashed on the (cached) kernel and reused across builders.
+                kernel = kinfo.kernel
+                assert isinstance(kernel._code, ast.Node)
+                try:
+                    kast = kernel._eigen_code
+                except AttributeError:
+                    kast = transformer.visit(kernel._code)
+                    kernel._eigen_code = kast
                 templated_subkernels.append(kast)
-                include_dirs.extend(kinfo.kernel._include_dirs)
+                include_dirs.extend(kernel._include_dirs)
                 oriented = oriented or kinfo.oriented
 
         # Add subdomain call to assembly dict
@@ -304,7 +349,7 @@ class LocalKernelBuilder(object):
 
         self.assembly_calls = assembly_calls
         self.templated_subkernels = templated_subkernels
-        self.include_dirs = list(set(include_dirs))
+        self.include_dirs = list(OrderedDict.fromkeys(include_dirs))
         self.oriented = oriented
         self.needs_cell_sizes = needs_cell_sizes
 
@@ -316,31 +361,37 @@ class LocalKernelBuilder(object):
         """
         coefficient_map = OrderedDict()
         for i, coefficient in enumerate(self.expression.coefficients()):
-            if type(coefficient.ufl_element()) == MixedElement:
-                csym_info = []
-                for j, _ in enumerate(coefficient.split()):
-                    csym_info.append(ast.Symbol("w_%d_%d" % (i, j)))
+            element = coefficient.ufl_element()
+            if type(element) == MixedElement:
+                csym_info = tuple(ast.Symbol("w_%d_%d" % (i, j))
+                                  for j in range(element.num_sub_elements()))
             else:
                 csym_info = (ast.Symbol("w_%d" % i),)
 
-            coefficient_map[coefficient] = tuple(csym_info)
+            coefficient_map[coefficient] = csym_info
 
         return coefficient_map
 
+    @cached_property
+    def _coefficient_map_by_id(self):
+        """The :attr:`coefficient_map` keyed on coefficient identity,
+        which avoids hashing UFL coefficients on every lookup. The
+        coefficients are kept alive by :attr:`coefficient_map`.
+        """
+        return {id(c): csyms for c, csyms in self.coefficient_map.items()}
+
     def coefficient(self, coefficient):
         """Extracts the kernel arguments corresponding to a particular coefficient.
         This handles both the case when the coefficient is defined on a mixed
         or non-mixed function space.
         """
-        return self.coefficient_map[coefficient]
+        return self._coefficient_map_by_id[id(coefficient)]
 
     @cached_property
     def context_kernels(self):
         r"""Gathers all :class:`~.ContextKernel`\s containing all TSFC kernels,
         and integral type information.
         """
-        from firedrake.slate.slac.tsfc_driver import compile_terminal_form
-
         cxt_list = [compile_terminal_form(expr, prefix="subkernel%d_" % i,
                                           tsfc_parameters=self.tsfc_parameters)
                     for i, expr in enumerate(self.temps)]
@@ -360,11 +411,7 @@ class LocalKernelBuilder(object):
         which require looping over cell facets. If any are found, this function
         returns `True` and `False` otherwise.
         """
-        cell_facet_types = ["interior_facet",
-                            "exterior_facet",
-                            "interior_facet_vert",
-                            "exterior_facet_vert"]
-        return any(cxt_k.original_integral_type in cell_facet_types
+        return any(cxt_k.original_integral_type in self.cell_facet_types
                    for cxt_k in self.context_kernels)
 
     @cached_property
@@ -373,9 +420,5 @@ class LocalKernelBuilder(object):
         which require mesh level information (extrusion measures). If any are
         found, this function returns `True` and `False` otherwise.
         """
-        mesh_layer_types = ["interior_facet_horiz_top",
-                            "interior_facet_horiz_bottom",
-                            "exterior_facet_bottom",
-                            "exterior_facet_top"]
-        return any(cxt_k.original_integral_type in mesh_layer_types
+        return any(cxt_k.original_integral_type in self.mesh_layer_types
                    for cxt_k in self.context_kernels)
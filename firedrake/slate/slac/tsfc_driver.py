@@ -2,6 +2,7 @@ import collections
 
 from functools import partial
 
+from firedrake.parameters import parameters
 from firedrake.slate.slate import Tensor
 from firedrake.slate.slac.utils import RemoveRestrictions
 from firedrake.tsfc_interface import compile_form as tsfc_compile
@@ -52,6 +53,23 @@ def compile_terminal_form(tensor, prefix=None, tsfc_parameters=None):
     # the tensor name for code idempotency reasons, but is not
     # strictly required.
     prefix = prefix or "subkernel%s_" % tensor.__str__()
+
+    # Terminal tensors are shared between Slate expressions, so reuse
+    # any context kernels already compiled for this tensor. As in
+    # :func:`~.tsfc_interface.compile_form`, the key contains the
+    # global form compiler parameters updated with the user-specified
+    # ones, and the COFFEE parameters.
+    cache = tensor._metakernel_cache
+    params = parameters["form_compiler"].copy()
+    params.update(tsfc_parameters or {})
+    key = ("context_kernels", prefix,
+           str(sorted(params.items())),
+           str(sorted(parameters["coffee"].items())))
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
     mapper = RemoveRestrictions()
     integrals = map(partial(map_integrand_dags, mapper),
                     tensor.form.integrals())
@@ -73,7 +91,7 @@ def compile_terminal_form(tensor, prefix=None, tsfc_parameters=None):
 
     cxt_kernels = tuple(cxt_kernels)
 
-    return cxt_kernels
+    return cache.setdefault(key, cxt_kernels)
 
 
 def transform_integrals(integrals):
@@ -42,4 +42,4 @@ def do_projection(n, el_type, degree):
 def test_firedrake_projection_scalar_convergence(el, deg, convrate):
     diff = np.array([do_projection(i, el, deg) for i in range(1, 4)])
     conv = np.log2(diff[:-1] / diff[1:])
-    assert (np.array(conv) > convrate).all()
+    assert (conv > convrate).all()
@@ -1,6 +1,9 @@
+import numpy as np
 import pytest
 from firedrake import *
 from firedrake.slate.slac import compile_expression as compile_slate
+from firedrake.slate.slac.kernel_builder import LocalKernelBuilder
+from firedrake.slate.slac.tsfc_driver import compile_terminal_form
 
 
 @pytest.fixture(scope='module', params=[interval,
@@ -78,3 +81,79 @@ def test_determinism_and_caching(tensor):
 
     for k1, k2 in zip(kernel1, kernel3):
         assert k1 is not k2
+
+
+def test_context_kernel_caching():
+    """Tests that a terminal tensor shared between different Slate
+    expressions reuses its compiled context kernels, and that changing
+    the TSFC or COFFEE parameters produces new ones.
+    """
+    mesh = UnitSquareMesh(1, 1)
+    V = FunctionSpace(mesh, "DG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    A = Tensor(inner(u, v) * dx + inner(u, v) * ds)
+
+    cxt_kernels = compile_terminal_form(A, prefix="subkernel0_")
+    assert compile_terminal_form(A, prefix="subkernel0_") is cxt_kernels
+
+    # Two different expressions sharing the terminal A
+    for expr in [A.inv, A + A.T]:
+        builder = LocalKernelBuilder(expr)
+        assert len(builder.context_kernels) == len(cxt_kernels)
+        assert all(k1 is k2
+                   for k1, k2 in zip(builder.context_kernels, cxt_kernels))
+
+    # Changing TSFC parameters should change the kernels
+    vanilla = compile_terminal_form(A, prefix="subkernel0_",
+                                    tsfc_parameters={"mode": "vanilla"})
+    assert vanilla is not cxt_kernels
+
+    # ... as should changing the global COFFEE parameters
+    optlevel = parameters["coffee"]["optlevel"]
+    try:
+        parameters["coffee"]["optlevel"] = "O0"
+        coffee_O0 = compile_terminal_form(A, prefix="subkernel0_")
+    finally:
+        parameters["coffee"]["optlevel"] = optlevel
+    assert coffee_O0 is not cxt_kernels
+    assert compile_terminal_form(A, prefix="subkernel0_") is cxt_kernels
+
+
+def test_shared_terminal_subkernels():
+    """Tests that compiling one Slate expression does not affect the
+    subkernels generated for another expression sharing a terminal
+    tensor, and that both expressions assemble correctly.
+    """
+    mesh = UnitSquareMesh(2, 2)
+    V = FunctionSpace(mesh, "DG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    A = Tensor(inner(u, v) * dx)
+
+    subkernels = [k.gencode()
+                  for k in LocalKernelBuilder(A.inv).templated_subkernels]
+    Ainv = assemble(A.inv)
+
+    builder = LocalKernelBuilder(A + A.T)
+    assert [k.gencode() for k in builder.templated_subkernels] == subkernels
+
+    M = assemble(A).M.values
+    assert np.allclose(assemble(A + A.T).M.values, 2*M, rtol=1e-14)
+    assert np.allclose(Ainv.M.values, np.linalg.inv(M), rtol=1e-12)
+
+
+def test_templated_subkernel_reuse():
+    """Tests that the Eigen-templated subkernels generated for a
+    terminal tensor are reused by Slate expressions sharing it.
+    """
+    mesh = UnitSquareMesh(1, 1)
+    V = FunctionSpace(mesh, "DG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    A = Tensor(inner(u, v) * dx)
+
+    subkernels = LocalKernelBuilder(A.inv).templated_subkernels
+    other = LocalKernelBuilder(A + A.T).templated_subkernels
+    assert len(subkernels) == len(other) > 0
+    assert all(k1 is k2 for k1, k2 in zip(subkernels, other))